@@ -1,21 +1,68 @@
-import re
-import time
-from concurrent.futures import ThreadPoolExecutor
+import os
 import random
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import pandas as pd
+import numexpr as ne
+import numpy as np
 import plotly.express as px
+import pyarrow as pa
 import requests
 import streamlit as st
-from bs4 import BeautifulSoup
+from diskcache import Cache
+from lxml import etree, html
 from requests import HTTPError
-from fake_useragent import UserAgent
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 MAX_PAGES = 50
 RETRY_COUNT = 3  # Number of retries for failed requests
+MAX_WORKERS = int(os.environ.get("THREAD_POOL_SIZE", 16))  # Number of pages fetched concurrently
+CACHE_TTL = 3600  # Seconds scraped results are reused across sessions
+HISTOGRAM_BINS = 40
+
+RESULT_SCHEMA = pa.schema(
+    [
+        ("asin", pa.string()),
+        ("img", pa.string()),
+        ("description", pa.string()),
+        ("link", pa.string()),
+        ("price", pa.string()),
+        ("price_value", pa.float64()),
+        ("rating", pa.float64()),
+        ("number_of_reviews", pa.int64()),
+    ]
+)
+RESULT_COLUMNS = tuple(RESULT_SCHEMA.names)
+
+_PRICE_RE = re.compile(r"\d[\d.,]*")
+# Single-pass cleanup for Italian number formatting, e.g. "1.234,56"
+_PRICE_TABLE = str.maketrans({".": None, ",": "."})
+
+
+def _has_class(name):
+    # XPath 1.0 equivalent of the CSS ".name" class selector
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
 
-# Initialize UserAgent rotator
-ua = UserAgent()
+
+# Compiled once and reused for every result card
+_PAGINATION_XP = etree.XPath(f"//span[{_has_class('s-pagination-item')}]")
+_RESULTS_XP = etree.XPath('//div[@data-component-type="s-search-result"]')
+_IMG_XP = etree.XPath(f".//img[{_has_class('s-image')}]/@src")
+_PRICE_XP = etree.XPath(f".//span[{_has_class('a-price')}]//span[{_has_class('a-offscreen')}]")
+_RATING_XP = etree.XPath(
+    './/span[substring(@aria-label, string-length(@aria-label) - 6) = " stelle"'
+    ' and contains(@aria-label, " su ")]/@aria-label'
+)
+_REVIEWS_XP = etree.XPath('.//a[contains(@href, "#customerReviews")]')
+
+# User agents rotated between requests
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.0 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:131.0) Gecko/20100101 Firefox/131.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36 Edg/129.0.0.0",
+)
 
 def __response_hook(r, *args, **kwargs):
     try:
@@ -24,43 +71,111 @@ def __response_hook(r, *args, **kwargs):
     except HTTPError as e:
         if e.response.status_code >= 400:  # Only handle 4xx and 5xx errors
             raise HTTPError(
-                BeautifulSoup(r.text, "html.parser").text.strip(), request=e.request, response=e.response
+                html.fromstring(r.content).text_content().strip(), request=e.request, response=e.response
             ) from e
 
-session = requests.Session()
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    # Keep one pooled connection per concurrent page fetch and let urllib3 handle retries
+    adapter = HTTPAdapter(
+        pool_connections=MAX_PAGES,
+        pool_maxsize=MAX_PAGES,
+        max_retries=Retry(
+            total=RETRY_COUNT,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Retry error statuses and read failures for page fetches only, never for warm-up HEADs
+            allowed_methods=frozenset({"GET"}),
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+# Streamlit re-executes the script on every rerun; cache_resource hands back the same
+# session each time so its pooled connections survive slider moves
+session = get_session()
+
+@st.cache_resource
+def get_cache():
+    # Persistent cache of scraped pages and searches, keyed by (site, query[, page])
+    return Cache(".cache")
+
+# Opened once per process instead of on every rerun
+cache = get_cache()
+
+@st.cache_resource
+def get_executor():
+    # Shared across searches and Streamlit reruns so threads are only started once
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+@st.cache_resource
+def get_warm_up_executor():
+    # Kept apart from the page executor so connection warm-ups never delay real fetches
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
 def get(url, **kwargs):
-    # Rotate user agent
-    session.headers.update({"User-Agent": ua.random})
-    for attempt in range(RETRY_COUNT):  # Retry mechanism
-        try:
-            response = session.get(url, allow_redirects=True, **kwargs) # Explicit redirect handling
-            response.raise_for_status()
-            return response
-        except requests.exceptions.RequestException as e:
-            if attempt < RETRY_COUNT - 1:
-                wait_time = random.uniform(1, 3)  # Random delay between 1 and 3 seconds
-                time.sleep(wait_time)
-                print(f"Retrying request to {url} (Attempt {attempt + 2}/{RETRY_COUNT})")
-            else:
-                print(f"Failed to fetch {url} after {RETRY_COUNT} attempts: {e}")
-                raise  # Reraise the exception after all retries fail
-
-@st.cache_data
-def search(q: str):
+    # Rotate user agent per request so worker threads never mutate the shared session headers
+    headers = {"User-Agent": random.choice(USER_AGENTS)}
+    response = session.get(url, headers=headers, allow_redirects=True, **kwargs) # Explicit redirect handling
+    try:
+        response.raise_for_status()
+    except HTTPError:
+        # Streamed responses hold their pooled connection until closed
+        response.close()
+        raise
+    return response
+
+def warm_up(site):
+    # Open a pooled TLS connection ahead of the page fetches; real errors surface on those requests
+    url = f"https://{site}/"
+    headers = {"User-Agent": random.choice(USER_AGENTS)}
+    try:
+        session.head(url, headers=headers, allow_redirects=True, timeout=5)
+    except requests.RequestException:
+        pass
+
+def get_tree(url, **kwargs):
+    # Let lxml parse the body straight off the socket instead of buffering .content first
+    with get(url, stream=True, **kwargs) as response:
+        response.raw.decode_content = True
+        # Only trust the HTTP encoding if the server declared one, otherwise let lxml sniff it
+        declared = "charset" in response.headers.get("Content-Type", "")
+        parser = html.HTMLParser(encoding=response.encoding if declared else None)
+        root = html.parse(response.raw, parser).getroot()
+    # An empty body has no root element; treat it as a page without results
+    return root if root is not None else html.Element("html")
+
+class IncompleteResults(Exception):
+    # Raised by load_results so st.cache_data doesn't keep a captcha or partial search
+    def __init__(self, frame):
+        super().__init__("Some result pages came back empty")
+        self.frame = frame
+
+def search(q: str, on_progress=None):
+    # Returns the results and whether every page had results
     site = "amazon.it"
     url = f"https://{site}/s?k={q}"
 
-    soup = BeautifulSoup(get(url).content, "html.parser")
-    pages_elements = soup.find_all("span", "s-pagination-item")
-    pages = int(pages_elements[-1].text) if pages_elements else 1  # Handle cases where there's only one page
+    cached = cache.get((site, q))
+    if cached is not None:
+        return cached, True
+
+    # Establish the worker connections while the first page is downloaded
+    warm_up_executor = get_warm_up_executor()
+    for _ in range(MAX_WORKERS):
+        warm_up_executor.submit(warm_up, site)
+
+    # The first page is parsed once for both the page count and its results
+    first_page_tree = get_tree(url)
+    pages_elements = _PAGINATION_XP(first_page_tree)
+    pages = int(pages_elements[-1].text_content()) if pages_elements else 1  # Handle cases where there's only one page
 
     if pages > MAX_PAGES:
         pages = MAX_PAGES
 
-    def get_results(page: int):
-        soup = BeautifulSoup(get(url, params={"page": page}).content, "html.parser")
-        divs = soup.find_all("div", attrs={"data-component-type": "s-search-result"})
+    def parse_results(tree, page: int):
+        divs = _RESULTS_XP(tree)
 
         if not divs:
             print(f"No results found on page {page}.")
@@ -70,51 +185,37 @@ def search(q: str):
         for div in divs:
             try:
                 # Initialize result dict with all expected keys
-                result = {
-                    "asin": None,
-                    "img": None,
-                    "description": None,
-                    "link": None,
-                    "price": None,
-                    "rating": None,
-                    "number_of_reviews": None,
-                }
+                result = dict.fromkeys(RESULT_COLUMNS)
 
                 asin = div.get("data-asin")
                 result["asin"] = asin
-                img_tag = div.find("img", "s-image")
-                if img_tag:
-                    result["img"] = img_tag.get("src")
-                h2_tags = div.find_all("h2")
-                if h2_tags:
-                    result["description"] = ": ".join(
-                        h2.text.strip() for h2 in h2_tags
-                    )
+                img_src = _IMG_XP(div)
+                if img_src:
+                    result["img"] = str(img_src[0])
+                description = ": ".join(
+                    h2.text_content().strip() for h2 in div.iterfind(".//h2")
+                )
+                if description:
+                    result["description"] = description
                 result["link"] = f"https://{site}/dp/{asin}" if asin else None
 
-                price = div.find("span", "a-price")
-                if price:
-                    price_value = price.find("span", "a-offscreen")
-                    if price_value:
-                        result["price"] = price_value.text
-
-                rating = div.find(
-                    "span",
-                    attrs={
-                        "aria-label": lambda l: l
-                        and re.fullmatch(".* su .* stelle", l)
-                    },
-                )
+                price_value = _PRICE_XP(div)
+                if price_value:
+                    result["price"] = str(price_value[0].text_content())
+                    price_number = _PRICE_RE.search(result["price"])
+                    if price_number:
+                        result["price_value"] = float(price_number.group().translate(_PRICE_TABLE))
+
+                rating = _RATING_XP(div)
                 if rating:
-                    rating_value = rating.get("aria-label").split(" ")[0].replace(",", ".")
+                    rating_value = rating[0].split(" ")[0].replace(",", ".")
                     result["rating"] = float(rating_value)
 
-                number_of_reviews = div.find(
-                    "a", href=lambda h: h and "#customerReviews" in h
-                )
+                number_of_reviews = _REVIEWS_XP(div)
                 if number_of_reviews:
-                    reviews_text = number_of_reviews.text.strip()
-                    reviews_number = re.sub("[^0-9]", "", reviews_text)
+                    reviews_text = number_of_reviews[0].text_content().strip()
+                    # Drop separators, brackets and labels, e.g. "(1.234)" or "1\xa0234 valutazioni"
+                    reviews_number = "".join(filter(str.isdecimal, reviews_text))
                     if reviews_number:
                         result["number_of_reviews"] = int(reviews_number)
 
@@ -123,11 +224,59 @@ def search(q: str):
                 print(f"Error processing item: {e}")
         return results
 
-    with ThreadPoolExecutor() as t:
-        all_results = [
-            item for sublist in t.map(get_results, range(1, pages + 1)) for item in sublist
-        ]
-    return all_results
+    def get_results(page: int):
+        cached = cache.get((site, q, page))
+        if cached is not None:
+            return cached
+
+        results = parse_results(get_tree(url, params={"page": page}), page)
+        # Page 1 is always fetched for the page count, so only pages 2..N are cached
+        if results:
+            cache.set((site, q, page), results, expire=CACHE_TTL)
+        return results
+
+    # Start fetching the remaining pages before parsing the first one
+    executor = get_executor()
+    futures = {executor.submit(get_results, page): page for page in range(2, pages + 1)}
+    results_by_page = {1: parse_results(first_page_tree, 1)}
+    if on_progress:
+        on_progress(1, pages)
+
+    for future in as_completed(futures):
+        results_by_page[futures[future]] = future.result()
+        if on_progress:
+            on_progress(len(results_by_page), pages)
+
+    all_results = [item for page in sorted(results_by_page) for item in results_by_page[page]]
+    # An empty page is usually a captcha or bot check, so don't keep a partial search around
+    complete = all(results_by_page.values())
+    if complete:
+        cache.set((site, q), all_results, expire=CACHE_TTL)
+    return all_results, complete
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def load_results(q: str):
+    # Cached so slider reruns skip the disk cache and the frame rebuild; the progress bar
+    # lives in here because Streamlit only replays elements created inside cached functions
+    progress = st.progress(0.0, text="Ricerca in corso...")
+    results, complete = search(
+        q,
+        on_progress=lambda done, total: progress.progress(
+            done / total, text=f"Pagina {done} di {total}"
+        ),
+    )
+    progress.empty()
+
+    # Arrow builds one typed column per field, skipping pandas' per-row dtype inference
+    df = pa.Table.from_pylist(results, schema=RESULT_SCHEMA).to_pandas()
+    if not complete:
+        raise IncompleteResults(df)
+    return df
+
+@st.cache_data(ttl=CACHE_TTL)
+def price_histogram(prices):
+    # Binned once per result set so slider reruns only select from the precomputed bins
+    return np.histogram(prices, bins=HISTOGRAM_BINS)
 
 st.title("ASearch")
 st.subheader("Una ricerca migliore su Amazon")
@@ -135,20 +284,13 @@ st.subheader("Una ricerca migliore su Amazon")
 term = st.text_input("Cerca")
 
 if term:
-    df = pd.DataFrame(search(term))
+    try:
+        df = load_results(term)
+    except IncompleteResults as e:
+        # Show what was found without caching it, so the next run searches again
+        df = e.frame
 
     if not df.empty:
-        # Clean and convert the price column
-        if 'price' in df.columns:
-            df["price_value"] = (
-                df.price.str.replace("€", "")
-                .str.replace(".", "")
-                .str.replace(",", ".")
-                .astype(float, errors='ignore')
-            )
-        else:
-            df["price_value"] = None  # Assign None if 'price' column is missing
-
         # Determine price range for the slider
         if df["price_value"].notnull().any():
             price_min = float(df["price_value"].min())
@@ -165,9 +307,6 @@ if term:
             format="€%.2f",
         )
 
-        # Filter DataFrame based on price range
-        df_filtered = df[df["price_value"].between(*price_range)]
-
         # Define the columns you want to display
         columns_to_display = [
             "link",
@@ -179,7 +318,16 @@ if term:
         ]
 
         # Check which columns exist in your DataFrame
-        existing_columns = [col for col in columns_to_display if col in df_filtered.columns]
+        existing_columns = [col for col in columns_to_display if col in df.columns]
+
+        # numexpr fuses both price comparisons into one pass; NaN prices fall outside the range
+        lo, hi = price_range
+        mask = ne.evaluate(
+            "(price_value >= lo) & (price_value <= hi)",
+            local_dict={"price_value": df["price_value"].to_numpy(), "lo": lo, "hi": hi},
+        )
+        # Filter rows and select the displayed columns in one step
+        df_filtered = df.loc[mask, existing_columns]
 
         # Adjust the column configurations
         column_configurations = {
@@ -197,14 +345,24 @@ if term:
         }
 
         st.dataframe(
-            df_filtered[existing_columns],
+            df_filtered,
             column_config=existing_column_configurations,
             use_container_width=True,
         )
 
         # Plot the histogram if price data is available
-        if 'price_value' in df_filtered.columns and df_filtered['price_value'].notnull().any():
-            st.plotly_chart(px.histogram(df_filtered, x="price_value"))
+        if mask.any():
+            counts, edges = price_histogram(df["price_value"].dropna().to_numpy())
+            # Keep the bins that overlap the selected price range
+            visible = (edges[1:] >= lo) & (edges[:-1] <= hi)
+            centers = (edges[:-1] + edges[1:]) / 2
+            st.plotly_chart(
+                px.bar(
+                    x=centers[visible],
+                    y=counts[visible],
+                    labels={"x": "price_value", "y": "count"},
+                )
+            )
         else:
             st.write("No price data available to plot.")
     else: